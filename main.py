@@ -1,11 +1,22 @@
 import os
-import re
-import json
-from flask import Flask, request, jsonify
-import google.cloud.aiplatform as aiplatform
+import copy
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Annotated
+import orjson
+from flask import Flask, request
+from pydantic import AfterValidator, BaseModel, Field, HttpUrl, TypeAdapter, ValidationError
+import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2 import service_account
 from google.auth import default
+from google.api_core import retry
+from google.api_core.exceptions import PermissionDenied
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
 
@@ -14,253 +25,463 @@ GCP_REGION = os.environ.get('GCP_REGION', 'us-central1')
 # Gemini model name
 # Note: The model name may vary based on the version and region. Check the Vertex AI documentation for the latest model names.
 GEMINI_MODEL_NAME = "gemini-2.0-flash-lite-001"
+# Schema Gemini's JSON output is constrained to
+GEMINI_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "translated_summary": {"type": "string"},
+        "code_blocks": {"type": "array", "items": {"type": "string"}},
+        "page_title": {"type": "string"},
+        "keywords": {"type": "string"},
+    },
+    "required": ["translated_summary", "code_blocks", "page_title", "keywords"],
+}
+# Threads per gunicorn worker (Dockerfile --threads); also sizes the background pool
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 16))
+# Documents that may be in flight per process before new requests get a 503
+MAX_PENDING_DOCS = WORKER_THREADS * 2
+# Socket timeout (seconds) for Google Docs/Drive API calls
+GOOGLE_API_TIMEOUT = 30
+# Longest input text sent to Gemini; longer text is cut at a paragraph boundary
+MAX_INPUT_CHARS = 30000
+# Static part of the Gemini prompt, built once and sent ahead of the per-request parts
+_PROMPT_PREFIX = Part.from_text("""以下の「元のテキスト」と「元のURL」を指定の形式で処理してください。
+
+# 処理指示:
+1.  元のテキストを日本語に自然に和訳してください。
+2.  和訳した内容は、表現をわかりやすく変換し、ポイントを箇条書き（各項目の先頭は「・」、改行区切り）でまとめてください。(translated_summary)
+3.  元のテキストに含まれるコードブロック（```で囲まれた部分）は、内容を保持し、コードブロックとしてわかるように ``` で囲んでください。(code_blocks)
+4.  元のURLからWebページのタイトルを取得してください。(page_title)
+5.  和訳した文章の内容と元のテキストのテーマに最も関連性の高い重要な名詞を10個程度、カンマ区切りでリストアップしてください。固有名詞や専門用語を優先してください。(keywords)
+""")
+# Maximum number of Gemini results kept in the in-process cache
+GEMINI_CACHE_MAXSIZE = 1024
+
+# HTTP statuses of Docs/Drive API errors that are worth retrying
+TRANSIENT_HTTP_STATUSES = (429, 500, 502, 503, 504)
 
 # Configure Google Docs API 
 # No key file needed as it uses runtime service account
 SCOPES = ['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive.file']
 
+# Log level (success lines of each request are logged at DEBUG)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# --- Logging ---
+logger = logging.getLogger(__name__)
+_log_level = logging.getLevelName(LOG_LEVEL)
+if not isinstance(_log_level, int):
+    _log_level = logging.INFO
+
+def _configure_logging():
+    """Send logs to Cloud Logging on Cloud Run, otherwise to stderr"""
+    if os.environ.get('K_SERVICE'):
+        try:
+            from google.cloud.logging.handlers import StructuredLogHandler, setup_logging
+        except ImportError:
+            pass
+        else:
+            # On Cloud Run, write structured (JSON) logs to stdout. Unlike the API
+            # transport this starts no background thread, so it survives gunicorn's
+            # --preload fork.
+            setup_logging(StructuredLogHandler(), log_level=_log_level)
+            return
+    logging.basicConfig(level=_log_level, format='%(levelname)s %(message)s')
+
+_configure_logging()
+
 # Flask
 app = Flask(__name__)
 
+# Worker pool running the Gemini call and document write of each request,
+# sized like the request threads so background work keeps up with them
+_EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+# Separate pool for single API calls awaited by _EXECUTOR jobs, so a job
+# never waits on work queued behind itself (each write awaits two)
+_API_EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_THREADS * 2)
+# Bounds the documents queued for _EXECUTOR; held from request until the write ends
+_pending_docs = threading.BoundedSemaphore(MAX_PENDING_DOCS)
+
+# --- Retry of transient Google API failures ---
+def _is_transient_error(exc):
+    """Whether a Google API failure is transient, so the call may be repeated"""
+    if isinstance(exc, HttpError):
+        return exc.resp.status in TRANSIENT_HTTP_STATUSES
+    return isinstance(exc, (ConnectionError, TimeoutError)) or retry.if_transient_error(exc)
+
+# Exponential backoff for idempotent calls only (never for files().create)
+_API_RETRY = retry.Retry(predicate=_is_transient_error, initial=0.2, maximum=4.0, multiplier=2.0, timeout=30)
+
+# In-process LRU cache of Gemini results, keyed by text digest + URL
+_gemini_cache = OrderedDict()
+_gemini_cache_lock = threading.Lock()
+
 # Init Gemini Client
 vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION)
-aiplatform.init(project=GCP_PROJECT_ID, location=GCP_REGION)
-gemini_model = aiplatform.gapic.PredictionServiceClient(client_options={"api_endpoint": f"{GCP_REGION}-aiplatform.googleapis.com"})
+# Shared across requests so the underlying channel and credentials are reused
+_GEMINI_MODEL = GenerativeModel(GEMINI_MODEL_NAME)
 
 # --- Google Docs client initialization ---
 try:
     # In Cloud Run environment, use default credentials for Runtime Service account
     credentials, project = default(scopes=SCOPES)
-    docs_service = build('docs', 'v1', credentials=credentials)
-    drive_service = build('drive', 'v3', credentials=credentials)
 except Exception as e:
-    print(f"Error initializing Google API clients: {e}")
-    docs_service = None
-    drive_service = None
+    logger.error("Error initializing Google API clients: %s", e)
+    credentials = None
+
+# httplib2.Http is not thread-safe, so each thread builds its own clients.
+# Discovery documents bundled with google-api-python-client are used, so
+# building a client does not fetch discovery JSON over the network.
+_thread_local = threading.local()
+
+def _authorized_http():
+    """Create a new authorized HTTP transport for the Google API clients"""
+    return AuthorizedHttp(credentials, http=httplib2.Http(cache=None, timeout=GOOGLE_API_TIMEOUT))
+
+def get_docs_service():
+    """Return the Docs API client for the current thread"""
+    service = getattr(_thread_local, 'docs_service', None)
+    if service is None:
+        service = build('docs', 'v1', http=_authorized_http(), static_discovery=True, cache_discovery=False)
+        _thread_local.docs_service = service
+    return service
+
+def get_drive_service():
+    """Return the Drive API client for the current thread"""
+    service = getattr(_thread_local, 'drive_service', None)
+    if service is None:
+        service = build('drive', 'v3', http=_authorized_http(), static_discovery=True, cache_discovery=False)
+        _thread_local.drive_service = service
+    return service
 
 # --- helper function ---
-def get_page_title(url):
-    """Get the title of the page from the specified URL"""
-    try:
-        import requests
-        from bs4 import BeautifulSoup
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-        title = soup.title.string if soup.title else "Title unknown"
-        return title.strip()
-    except Exception as e:
-        print(f"Error fetching page title for {url}: {e}")
-        return "Title acquisition failure"
-
-def call_gemini(text_content, url):
-    """Call Gemini API for Japanese translation, formatting, and noun extraction"""
-    model = GenerativeModel(GEMINI_MODEL_NAME)
-    prompt = f"""以下のテキストを指定の形式で処理してください。
+def truncate_input(text_content):
+    """Cut text to MAX_INPUT_CHARS, preferring the last paragraph break in its second half"""
+    if len(text_content) <= MAX_INPUT_CHARS:
+        return text_content, False
+    cut_index = text_content.rfind('\n\n', 0, MAX_INPUT_CHARS)
+    # An early break would drop most of the allowed text, so cut at the limit instead
+    if cut_index < MAX_INPUT_CHARS // 2:
+        cut_index = MAX_INPUT_CHARS
+    return text_content[:cut_index], True
+
+def generate_prediction(contents, generation_config):
+    """Stream a Gemini response and return its full text"""
+    # Stream the response so tokens are received as they are generated
+    responses = _GEMINI_MODEL.generate_content(
+        contents,
+        generation_config=generation_config,
+        stream=True,
+    )
 
-# 元のテキスト:
-```
-{text_content}
-```
+    chunks = []
+    for chunk in responses:
+        # The last chunk may carry only finish metadata and no text
+        if chunk.candidates and chunk.candidates[0].content.parts:
+            chunks.append(chunk.text)
+    return "".join(chunks)
 
-# 元のURL:
-{url}
+def call_gemini(text_content, url):
+    """Call Gemini API for Japanese translation, formatting, and noun extraction (raises on failure)"""
+    # Bound input tokens (and so latency and cost) for very long submissions
+    text_content, truncated = truncate_input(text_content)
 
-# 処理指示:
-1.  元のテキストを日本語に自然に和訳してください。
-2.  和訳した内容は、表現をわかりやすく変換し、ポイントを箇条書き（各項目の先頭は「・」）でまとめてください。
-3.  元のテキストに含まれるコードブロック（```で囲まれた部分）は、内容を保持し、コードブロックとしてわかるように ``` で囲んでください。
-4.  元のURLからWebページのタイトルを取得してください。
-5.  和訳した文章の内容と元のテキストのテーマに最も関連性の高い重要な名詞を10個程度、カンマ区切りでリストアップしてください。固有名詞や専門用語を優先してください。
-
-# 出力形式 (JSON):
-```json
-{{
-  "translated_summary": "・箇条書き1\n・箇条書き2\n・箇条書き3...",
-  "code_blocks": [
-    "```python\nprint('hello')\n```",
-    "```javascript\nconsole.log('world');\n```"
-  ],
-  "page_title": "取得したページタイトル",
-  "keywords": "名詞1, 名詞2, 名詞3, ..."
-}}
-```
-
-上記形式に従って、JSON文字列のみを出力してください。
-"""
-
-    # Generation settings (optional)
+    # Generation settings (JSON output is enforced by the response schema)
     generation_config = GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=GEMINI_RESPONSE_SCHEMA,
         temperature=0.5,
         max_output_tokens=2048,
         top_k=40,
         top_p=0.9
     )
 
-    try:
-        response = model.generate_content(
-            [Part.from_text(prompt)],
-            generation_config=generation_config,
-        )
+    contents = [
+        _PROMPT_PREFIX,
+        Part.from_text(f"# 元のテキスト:\n```\n{text_content}\n```"),
+        Part.from_text(f"# 元のURL:\n{url}"),
+    ]
 
-        prediction = response.text
+    prediction = _API_RETRY(generate_prediction)(contents, generation_config)
 
-         # Attempt to parse JSON (note that Gemini output is not always as expected)
-        try:
-            cleaned_prediction = re.sub(r'^```json\s*', '', prediction.strip())
-            cleaned_prediction = re.sub(r'\s*```$', '', cleaned_prediction)
-            result = json.loads(cleaned_prediction)
-            return result
-        except json.JSONDecodeError as e:
-            print(f"Error decoding Gemini JSON response: {e}")
-            print(f"Raw Gemini response: {prediction}")
-            # Fallback: parse failure returns a dictionary with error information
-            return {
-                "translated_summary": f"Gemini応答のJSON解析失敗: {e}\nRaw: {prediction}",
-                "code_blocks": [],
-                "page_title": "Failure",
-                "keywords": "Extraction failure"
-            }
+    result = orjson.loads(prediction)
+    if truncated:
+        result["translated_summary"] = (
+            f"{result.get('translated_summary', '')}\n"
+            f"・（元のテキストが長いため、先頭{len(text_content)}文字のみを処理しました）"
+        )
+    return result
+
+def gemini_failure_result(error):
+    """Fallback result written to the document when the Gemini call fails"""
+    return {
+        "translated_summary": f"Gemini API呼び出しエラー: {error}",
+        "code_blocks": [],
+        "page_title": "Failure",
+        "keywords": "Extraction failure"
+    }
+
+def share_with_admin(document_id):
+    """Grant the admin account read access to the document."""
+    permission = {
+        'type': 'user',
+        'role': 'reader',
+        'emailAddress': os.environ.get("ADMIN_ACOUNT")
+    }
+    try:
+        _API_RETRY(get_drive_service().permissions().create(
+            fileId=document_id,
+            body=permission,
+            fields='id'
+        ).execute)()
+        logger.debug("Shared document %s with admin", document_id)
+    except Exception as share_e:
+        logger.error("Error sharing document %s: %s", document_id, share_e)
+
+def gemini_cache_key(text_content, url):
+    """Build the cache key for a (text, url) submission"""
+    digest = hashlib.blake2b(text_content.strip().encode('utf-8'), digest_size=16).hexdigest()
+    return digest + url
+
+def lookup_gemini_cache(text_content, url):
+    """Return a copy of the cached Gemini result for the submission, or None"""
+    key = gemini_cache_key(text_content, url)
+    with _gemini_cache_lock:
+        cached = _gemini_cache.get(key)
+        if cached is None:
+            return None
+        _gemini_cache.move_to_end(key)
+    # Hand out a copy so callers cannot mutate the cached entry
+    return copy.deepcopy(cached)
+
+def fetch_gemini_result(text_content, url):
+    """Call Gemini for the submission and cache the result"""
+    try:
+        result = call_gemini(text_content, url)
+    except PermissionDenied as e:
+        logger.error("Vertex AI Permission Denied. Ensure the service account has 'Vertex AI User' role: %s", e)
+        return gemini_failure_result(e)
     except Exception as e:
-        print(f"Error calling Gemini API via GenerativeModel: {e}")
-        import traceback
-        traceback.print_exc()
-        return {
-            "translated_summary": f"Gemini API呼び出しエラー: {e}",
-            "code_blocks": [],
-            "page_title": "Failure",
-            "keywords": "Extraction failure"
-        }
-
-def create_google_doc(title, content_requests):
-    """Create a Google Doc and write in the content and style specified."""
-    if not docs_service or not drive_service:
+        logger.exception("Error calling Gemini API via GenerativeModel: %s", e)
+        # Fallback results from failed calls are not cached
+        return gemini_failure_result(e)
+
+    key = gemini_cache_key(text_content, url)
+    with _gemini_cache_lock:
+        _gemini_cache[key] = copy.deepcopy(result)
+        _gemini_cache.move_to_end(key)
+        if len(_gemini_cache) > GEMINI_CACHE_MAXSIZE:
+            _gemini_cache.popitem(last=False)
+    return result
+
+def delete_doc(document_id):
+    """Delete a partially created document."""
+    try:
+        _API_RETRY(get_drive_service().files().delete(fileId=document_id).execute)()
+        logger.info("Cleaned up partially created document: %s", document_id)
+    except Exception as delete_e:
+        logger.error("Error deleting partially created document %s: %s", document_id, delete_e)
+
+def create_doc(title):
+    """Create an empty Google Doc (using Drive API) and return its ID and URL."""
+    if not credentials:
         raise Exception("Google Docs or Drive service not initialized.")
 
+    doc_body = {
+        'name': title,
+        'mimeType': 'application/vnd.google-apps.document'
+    }
     try:
-        # 1. create a document (using Drive API)
-        doc_body = {
-            'name': title,
-            'mimeType': 'application/vnd.google-apps.document'
-        }
-        created_doc = drive_service.files().create(body=doc_body, fields='id,webViewLink').execute()
-        permission = {
-            'type': 'user',
-            'role': 'reader',
-            'emailAddress': os.environ.get("ADMIN_ACOUNT")
-        }
-        document_id = created_doc.get('id')
-        try:
-            drive_service.permissions().create(
-                fileId=document_id,
-                body=permission,
-                fields='id'
-            ).execute()
-            print(f"Shared document {document_id} with admin")
-        except Exception as share_e:
-            print(f"Error sharing document {document_id}: {share_e}")
-
-        doc_url = created_doc.get('webViewLink')
-
-        if not document_id:
-             raise Exception("Failed to create Google Doc, no ID returned.")
-
-        # 2. write content to a document (using Docs API)
-        result = docs_service.documents().batchUpdate(
+        created_doc = get_drive_service().files().create(body=doc_body, fields='id,webViewLink').execute()
+    except Exception as e:
+        logger.error("Error interacting with Google Docs/Drive API: %s", e)
+        raise
+
+    document_id = created_doc.get('id')
+    if not document_id:
+         raise Exception("Failed to create Google Doc, no ID returned.")
+    return document_id, created_doc.get('webViewLink')
+
+def rename_doc(document_id, title):
+    """Set the final title of the document (using Drive API)."""
+    try:
+        _API_RETRY(get_drive_service().files().update(
+            fileId=document_id,
+            body={'name': title},
+            fields='id'
+        ).execute)()
+    except Exception as rename_e:
+        logger.error("Error renaming document %s: %s", document_id, rename_e)
+
+def doc_has_content(document_id):
+    """Whether the document body already holds more than the initial empty paragraph"""
+    doc = get_docs_service().documents().get(
+        documentId=document_id,
+        fields='body.content(endIndex)'
+    ).execute()
+    content = doc.get('body', {}).get('content', [])
+    return bool(content) and content[-1].get('endIndex', 1) > 2
+
+def write_content(document_id, content_requests):
+    """Apply the content requests (using Docs API), retrying transient failures"""
+    attempted = False
+
+    def attempt():
+        nonlocal attempted
+        # A failed attempt may still have been applied; never insert the text twice
+        if attempted and doc_has_content(document_id):
+            return
+        attempted = True
+        get_docs_service().documents().batchUpdate(
             documentId=document_id,
             body={'requests': content_requests}
         ).execute()
 
-        print(f"Google Doc created: {doc_url}")
-        return doc_url
+    _API_RETRY(attempt)()
+
+def write_doc(document_id, title, content_requests):
+    """Write the content and style specified into a created document and share it."""
+    try:
+        # Rename and share with admin while the content is written (using Docs API).
+        # Drive and Docs only accept batches on their own endpoints, so the
+        # independent calls are overlapped instead of sent as one HTTP batch.
+        rename_future = _API_EXECUTOR.submit(rename_doc, document_id, title)
+        share_future = _API_EXECUTOR.submit(share_with_admin, document_id)
+        try:
+            write_content(document_id, content_requests)
+        finally:
+            share_future.result()
+            rename_future.result()
 
     except Exception as e:
-        print(f"Error interacting with Google Docs/Drive API: {e}")
+        logger.error("Error interacting with Google Docs/Drive API: %s", e)
         # Attempt to delete a document in progress if an error occurs (optional)
-        if 'document_id' in locals() and document_id:
-            try:
-                drive_service.files().delete(fileId=document_id).execute()
-                print(f"Cleaned up partially created document: {document_id}")
-            except Exception as delete_e:
-                print(f"Error deleting partially created document {document_id}: {delete_e}")
+        delete_doc(document_id)
         raise
 
+def fill_doc(document_id, text_content, url, gemini_future):
+    """Write the finished Gemini result into the created document"""
+    # Gemini failures already resolve to the fallback result, so this never raises
+    gemini_result = gemini_future.result()
+    logger.debug("Gemini processing complete for document %s.", document_id)
+
+    try:
+        doc_title = f"{gemini_result.get('page_title', 'No Title')} - {text_content[:20]}..."
+
+        # Creating Docs API request
+        content_requests = format_docs_requests(gemini_result, url)
+    except Exception as e:
+        logger.exception("Error preparing Google Doc %s: %s", document_id, e)
+        # Nothing will be written, so do not leave an empty document behind
+        delete_doc(document_id)
+        return
+
+    try:
+        logger.debug("Writing Google Doc with title: %s", doc_title)
+        # Edit Google Document (write_doc deletes the document if this fails)
+        write_doc(document_id, doc_title, content_requests)
+        logger.debug("Successfully wrote Google Doc: %s", document_id)
+    except Exception as e:
+        logger.exception("Error completing Google Doc %s: %s", document_id, e)
+
+def complete_doc(document_id, text_content, url, gemini_future):
+    """Background job finishing a document, then freeing its pending slot"""
+    try:
+        fill_doc(document_id, text_content, url, gemini_future)
+    finally:
+        _pending_docs.release()
+
+def _docs_len(text):
+    """Length of text in UTF-16 code units, the unit Docs API indices use"""
+    return len(text.encode('utf-16-le')) // 2
+
 def format_docs_requests(gemini_result, url):
     """Convert Gemini results to Google Docs API request format"""
-    requests_list = []
+    # Pass 1: assemble the full document text and record the regions to style
+    text_parts = []
+    regions = []
     current_index = 1
+    # Whether only blank text follows the last region, so a same-kind region can extend it
+    region_open = False
+
+    def add_text(text, kind=None, payload=None):
+        nonlocal current_index, region_open
+        start_index = current_index
+        text_parts.append(text)
+        current_index += _docs_len(text)
+        if kind:
+            # Consecutive bullet lines / code blocks share one style request
+            if region_open and kind in ('bullet', 'code') and regions[-1][0] == kind:
+                start_index = regions.pop()[1]
+            regions.append((kind, start_index, current_index, payload))
+            region_open = True
+        elif text.strip():
+            region_open = False
 
     # --- 1. Summary ---
-    requests_list.append({
-        'insertText': {
-            'location': {'index': current_index},
-            'text': "1 - Summary\n"
-        }
-    })
-    current_index += len("1 - Summary\n")
-    requests_list.append({
-        'updateParagraphStyle': {
-            'range': {'startIndex': 1, 'endIndex': current_index},
-            'paragraphStyle': {'namedStyleType': 'HEADING_1'},
-            'fields': 'namedStyleType'
-        }
-    })
+    add_text("1 - Summary\n", 'heading', 'HEADING_1')
 
     summary_lines = gemini_result.get("translated_summary", "和訳の取得に失敗しました。").split('\n')
     for line in summary_lines:
         if line.strip():
-            # Insert while maintaining bullet ".
-            line_text = line + "\n"
-            requests_list.append({
-                'insertText': {
-                    'location': {'index': current_index},
-                    'text': line_text
-                }
-            })
-            line_start_index = current_index
-            current_index += len(line_text)
-
             # Apply bullet style (with “.” at the beginning of a line)
             if line.strip().startswith('・'):
-                 requests_list.append({
-                    'createParagraphBullets': {
-                        'range': {
-                            'startIndex': line_start_index,
-                            'endIndex': current_index -1
-                        },
-                        'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
-                    }
-                 })
+                add_text(line, 'bullet')
+                add_text("\n")
+            else:
+                add_text(line + "\n")
 
     # --- Code block ---
     code_blocks = gemini_result.get("code_blocks", [])
     if code_blocks:
-         requests_list.append({
-             'insertText': {
-                 'location': {'index': current_index},
-                 'text': "\nCode block:\n" # Code block title
-             }
-         })
-         current_index += len("\nCode block:\n")
-
-         for code_block in code_blocks:
-            code_text = code_block + "\n\n"
+        add_text("\nCode block:\n") # Code block title
+        for code_block in code_blocks:
+            add_text(code_block, 'code')
+            add_text("\n\n")
+
+    # --- 2. URL and Page title ---
+    page_title = gemini_result.get("page_title", "Title acquisition failure")
+    add_text("\n")
+    add_text(f"2 - URL - {page_title}", 'heading', 'HEADING_2')
+    add_text("\n")
+    add_text(url, 'link', url)
+    add_text("\n")
+
+    # --- 3. noun list ---
+    keywords = gemini_result.get("keywords", "Extraction failure")
+    add_text("\n")
+    add_text("3 - 関連キーワード", 'heading', 'HEADING_2')
+    add_text(f"\n{keywords}\n")
+
+    # Pass 2: one insert for the whole text, then styles from the recorded offsets
+    requests_list = [{
+        'insertText': {
+            'location': {'index': 1},
+            'text': ''.join(text_parts)
+        }
+    }]
+    for kind, start_index, end_index, payload in regions:
+        text_range = {'startIndex': start_index, 'endIndex': end_index}
+        if kind == 'heading':
             requests_list.append({
-                'insertText': {
-                    'location': {'index': current_index},
-                    'text': code_text
+                'updateParagraphStyle': {
+                    'range': text_range,
+                    'paragraphStyle': {'namedStyleType': payload},
+                    'fields': 'namedStyleType'
                 }
             })
-            code_start_index = current_index
-            current_index += len(code_text)
-
+        elif kind == 'bullet':
+            requests_list.append({
+                'createParagraphBullets': {
+                    'range': text_range,
+                    'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
+                }
+            })
+        elif kind == 'code':
             # Apply monospace font style to code block section
             requests_list.append({
                 'updateTextStyle': {
-                    'range': {'startIndex': code_start_index, 'endIndex': current_index - 2},
+                    'range': text_range,
                     'textStyle': {
                         'weightedFontFamily': {
                             'fontFamily': 'Courier New', # Monospace font
@@ -270,58 +491,39 @@ def format_docs_requests(gemini_result, url):
                     'fields': 'weightedFontFamily,fontSize'
                 }
             })
+        elif kind == 'link':
+            # Apply link style to URL portion
+            requests_list.append({
+                'updateTextStyle': {
+                    'range': text_range,
+                    'textStyle': {
+                        'link': {'url': payload}
+                    },
+                    'fields': 'link'
+                }
+            })
 
-    # --- 2. URL and Page title ---
-    page_title = gemini_result.get("page_title", "Title acquisition failure")
-    url_text = f"\n2 - URL - {page_title}\n{url}\n"
-    requests_list.append({
-        'insertText': {
-            'location': {'index': current_index},
-            'text': url_text
-        }
-    })
-    url_title_start_index = current_index + 1
-    current_index += len(url_text)
-    requests_list.append({
-        'updateParagraphStyle': {
-            'range': {'startIndex': url_title_start_index, 'endIndex': url_title_start_index + len(f"2 - URL - {page_title}")},
-            'paragraphStyle': {'namedStyleType': 'HEADING_2'},
-            'fields': 'namedStyleType'
-        }
-    })
-    # Apply link style to URL portion
-    requests_list.append({
-        'updateTextStyle': {
-            'range': {'startIndex': current_index - len(url) -1 , 'endIndex': current_index -1},
-            'textStyle': {
-                'link': {'url': url}
-            },
-            'fields': 'link'
-        }
-    })
+    return requests_list
 
 
-    # --- 3. noun list ---
-    keywords = gemini_result.get("keywords", "Extraction failure")
-    keywords_text = f"\n3 - 関連キーワード\n{keywords}\n"
-    requests_list.append({
-        'insertText': {
-            'location': {'index': current_index},
-            'text': keywords_text
-        }
-    })
-    keywords_title_start_index = current_index + 1
-    current_index += len(keywords_text)
-    requests_list.append({
-        'updateParagraphStyle': {
-            'range': {'startIndex': keywords_title_start_index, 'endIndex': keywords_title_start_index + len("3 - 関連キーワード")},
-            'paragraphStyle': {'namedStyleType': 'HEADING_2'},
-            'fields': 'namedStyleType'
-        }
-    })
+_HTTP_URL_ADAPTER = TypeAdapter(HttpUrl)
 
-    return requests_list
+def _check_http_url(value):
+    """Validate value as an HTTP(S) URL but keep the string as given (HttpUrl would normalize it)"""
+    try:
+        _HTTP_URL_ADAPTER.validate_python(value)
+    except ValidationError as e:
+        raise ValueError(e.errors(include_url=False)[0]['msg']) from None
+    return value
+
+class ProcessTextRequest(BaseModel):
+    """Request body of the POST / endpoint"""
+    text: str = Field(min_length=1, max_length=100_000)
+    url: Annotated[str, AfterValidator(_check_http_url)]
 
+def json_response(payload, status=200):
+    """Serialize the payload with orjson into a Flask JSON response"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
 
 # main
 @app.route('/', methods=['POST'])
@@ -332,53 +534,68 @@ def process_text():
     api_key = request.headers.get('X-API-Key')
     # Check if API key is valid (compare with stored key)
     if not api_key or api_key != os.environ.get('API_KEY'):
-        return jsonify({"error": "Unauthorized - Invalid or missing API key"}), 401
+        return json_response({"error": "Unauthorized - Invalid or missing API key"}, 401)
     
     if not request.is_json:
-        return jsonify({"error": "Request must be JSON"}), 400
+        return json_response({"error": "Request must be JSON"}, 400)
 
-    data = request.get_json()
-    text_content = data.get('text')
-    url = data.get('url')
-
-    if not text_content or not url:
-        return jsonify({"error": "Missing 'text' or 'url' in request body"}), 400
+    try:
+        body = ProcessTextRequest.model_validate_json(request.get_data())
+    except ValidationError as e:
+        return json_response({
+            "error": "Invalid request body",
+            "details": e.errors(include_url=False, include_context=False, include_input=False)
+        }, 400)
+    text_content = body.text
+    url = body.url
 
     if not GCP_PROJECT_ID:
-         return jsonify({"error": "GCP_PROJECT_ID environment variable not set."}), 500
+         return json_response({"error": "GCP_PROJECT_ID environment variable not set."}, 500)
 
-    if not docs_service or not drive_service:
-         return jsonify({"error": "Google API services failed to initialize. Check logs."}), 500
+    if not credentials:
+         return json_response({"error": "Google API services failed to initialize. Check logs."}, 500)
 
-    try:
-        # 1. Calling Gemini for URL
-        print(f"Calling Gemini for URL: {url}")
-        gemini_result = call_gemini(text_content, url)
-        print("Gemini processing complete.")
-
-        # 2. Creating Google Document
-        doc_title = f"{gemini_result.get('page_title', 'No Title')} - {text_content[:20]}..."
-        print(f"Creating Google Doc with title: {doc_title}")
+    # Reject rather than queue without bound once the background pool is saturated
+    if not _pending_docs.acquire(blocking=False):
+        return json_response({"error": "Server busy. Retry later."}, 503)
 
-        # Creating Docs API request
-        content_requests = format_docs_requests(gemini_result, url)
-
-        # Edit Google Document
-        doc_url = create_google_doc(doc_title, content_requests)
-        print(f"Successfully created Google Doc: {doc_url}")
+    try:
+        # 1. Calling Gemini for URL in the background, unless the result is cached.
+        # The same lookup decides X-Cache and feeds the write, so they always agree.
+        cached_result = lookup_gemini_cache(text_content, url)
+        cache_hit = cached_result is not None
+        if cache_hit:
+            gemini_future = Future()
+            gemini_future.set_result(cached_result)
+        else:
+            logger.debug("Calling Gemini for URL: %s", url)
+            gemini_future = _EXECUTOR.submit(fetch_gemini_result, text_content, url)
+
+        # 2. Creating Google Document while Gemini runs (the doc ID does not depend on its output)
+        try:
+            document_id, doc_url = create_doc(f"{text_content[:20]}...")
+        except Exception:
+            # No write will follow; free the slot once the Gemini call is done
+            gemini_future.add_done_callback(lambda future: _pending_docs.release())
+            raise
+        logger.debug("Created Google Doc: %s", doc_url)
+
+        # 3. Writing the content once Gemini is done. The write is queued as a new
+        # task rather than awaited inside a worker, so the pool cannot deadlock.
+        gemini_future.add_done_callback(
+            lambda future: _EXECUTOR.submit(complete_doc, document_id, text_content, url, future)
+        )
 
-        # 3. Returning the document URL
-        return jsonify({"document_url": doc_url})
+        # 4. Returning the document URL (the content is written in the background)
+        response = json_response({"document_url": doc_url, "status": "pending"})
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        return response
 
-    except aiplatform.exceptions.PermissionDenied as e:
-        print(f"Vertex AI Permission Denied: {e}")
-        return jsonify({"error": f"Vertex AI Permission Denied. Ensure the service account has 'Vertex AI User' role. Details: {e}"}), 500
     except Exception as e:
-        print(f"An error occurred: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": f"An internal server error occurred: {e}"}), 500
+        logger.exception("An error occurred: %s", e)
+        return json_response({"error": f"An internal server error occurred: {e}"}, 500)
 
 if __name__ == "__main__":
+    # Local development server only; the container runs the app under gunicorn
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
 